@@ -1,41 +1,101 @@
 import os
 import sys
+import orjson
 import logging
+import logging.handlers
 import stripe
 from dotenv import load_dotenv
 import datetime
-import pytz
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from markupsafe import Markup, escape
+from zoneinfo import ZoneInfo
 import time
-
-from flask import Flask, render_template, request, redirect, jsonify, session, send_from_directory
+import threading
+import queue
+import collections
+import hashlib
+import hmac
+import uuid
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.ssl_ import create_urllib3_context
+import redis
+from cachetools import TTLCache
+
+from flask import Flask, Response, render_template, request, redirect, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
 from waitress import serve
-
-# Configure logging
+from celery import Celery
+from celery.utils.time import get_exponential_backoff_interval
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Configure logging. Records are formatted by the calling thread and handed to a
+# queue; a listener thread does the stdout writes, so requests never block on I/O.
+log_queue_handler = logging.handlers.QueueHandler(None)
+log_stdout_handler = logging.StreamHandler(sys.stdout)  # Railway captures stdout; a second stderr handler only duplicated every line
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),  # This ensures logs go to stdout for Railway
-        logging.StreamHandler(sys.stderr)   # Capture errors as well
-    ]
+    handlers=[log_queue_handler]
 )
-logger = logging.getLogger(__name__)
 
-# Ensure logger has at least one handler
-if not logger.hasHandlers():
-    logger.addHandler(logging.StreamHandler(sys.stdout))
+def start_log_listener():
+    """Give this process its own log queue and a listener thread writing it to stdout"""
+    global log_listener
+    log_queue_handler.queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue_handler.queue, log_stdout_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+start_log_listener()
+# A forked child (e.g. a Celery prefork worker) gets a copy of the parent's listener
+# whose thread doesn't exist there, plus any records the parent hadn't written yet,
+# so it starts over with a fresh queue and listener
+os.register_at_fork(after_in_child=start_log_listener)
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 try:
     load_dotenv()
     logger.info("Environment variables loaded successfully")
 except Exception as e:
-    logger.error(f"Error loading environment variables: {e}")
+    logger.error("Error loading environment variables: %s", e)
     sys.exit(1)
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24))  # Add a secret key for session
+app.config['MAX_CONTENT_LENGTH'] = 1 << 20  # Werkzeug answers 413 for larger bodies before reading them
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)  # Client IP from Railway's proxy, used for rate limiting
+
+# Serve jsonify responses and request.get_json() through orjson instead of the stdlib json
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
+# stripe-python verifies TLS against its own CA bundle path, which makes urllib3 build a
+# new SSLContext and re-read the bundle on every new connection. Verify against one
+# context loaded from that bundle at startup instead.
+STRIPE_SSL_CONTEXT = create_urllib3_context()
+STRIPE_SSL_CONTEXT.load_verify_locations(stripe.ca_bundle_path)
+
+class StripeTLSAdapter(HTTPAdapter):
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        if pool_kwargs.get("ca_certs") == stripe.ca_bundle_path:
+            del pool_kwargs["ca_certs"]
+            pool_kwargs["ssl_context"] = STRIPE_SSL_CONTEXT
+        return host_params, pool_kwargs
 
 # Stripe configuration - Switch between live and test mode
 try:
@@ -47,81 +107,280 @@ try:
     
     # Check if the key is set
     if not stripe.api_key:
-        logger.error(f"Stripe API key is missing for mode: {stripe_mode.upper()}. Check environment variables.")
+        logger.error("Stripe API key is missing for mode: %s. Check environment variables.", stripe_mode.upper())
         sys.exit(1)
-    
-    logger.info(f"Stripe running in {stripe_mode.upper()} mode")
+
+    # One keep-alive session to api.stripe.com shared by all threads (the library otherwise
+    # opens a session per thread), with a bound on how long a call can hold a thread
+    stripe_timeout = int(os.getenv("STRIPE_TIMEOUT", 20))
+    # requests keeps at most 10 idle connections per host by default; gevent workers and the
+    # webhook pool can have more Stripe calls in flight, and the excess would be discarded
+    stripe_pool_size = int(os.getenv("STRIPE_POOL_SIZE", 50))
+    stripe_http_session = requests.Session()
+    stripe_http_session.mount("https://", StripeTLSAdapter(pool_maxsize=stripe_pool_size))
+    stripe.default_http_client = stripe.RequestsClient(timeout=stripe_timeout, session=stripe_http_session)
+
+    logger.info("Stripe running in %s mode", stripe_mode.upper())
 except Exception as e:
-    logger.error(f"Stripe configuration error: {e}")
+    logger.error("Stripe configuration error: %s", e)
     sys.exit(1)
 
-# Route for the first index page
-@app.route('/')
-def index():
-    logger.info("Root route accessed")
-    return render_template('index.html')
+# Webhook and email credentials - read once at startup instead of per request
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
+for name, value in (("STRIPE_WEBHOOK_SECRET", STRIPE_WEBHOOK_SECRET), ("SENDGRID_API_KEY", SENDGRID_API_KEY)):
+    if not value:
+        logger.error("%s is missing. Check environment variables.", name)
+        sys.exit(1)
+
+# Celery configuration - webhook processing and email delivery run on workers (see Procfile)
+# when REDIS_URL is set; without a broker, tasks execute inline in the calling thread
+redis_url = os.getenv("REDIS_URL")
+celery = Celery('fkgv', broker=redis_url or "memory://localhost/")
+celery.conf.task_always_eager = not redis_url
+# Slow SendGrid calls get their own queue so they never hold up webhook processing
+celery.conf.task_routes = {
+    'app.send_email': {'queue': 'email'},
+    'app.send_email_batch': {'queue': 'email'},
+}
+if redis_url:
+    logger.info("Celery broker configured, email delivery offloaded to worker")
+else:
+    logger.info("REDIS_URL not set, Celery tasks will run inline")
+
+# Shared Redis client (None when REDIS_URL is not configured)
+redis_client = redis.Redis.from_url(redis_url) if redis_url else None
+
+# Per-IP rate limits, shared across processes through Redis when available
+limiter = Limiter(get_remote_address, app=app, storage_uri=redis_url or "memory://")
+
+# Public base URL for Stripe redirect URLs (e.g. https://yourapp.up.railway.app/);
+# falls back to the request's host URL when unset
+BASE_URL = os.getenv("BASE_URL")
+if BASE_URL:
+    BASE_URL = BASE_URL.rstrip('/') + '/'
+
+def checkout_redirect_urls(base_url):
+    """(success_url, cancel_url) for Stripe Checkout under the given base URL"""
+    return f"{base_url}success?session_id={{CHECKOUT_SESSION_ID}}", f"{base_url}cancel"
+
+# With BASE_URL configured the redirect URLs are the same for every checkout
+CHECKOUT_REDIRECT_URLS = checkout_redirect_urls(BASE_URL) if BASE_URL else None
+
+# Longest username or game name accepted from the checkout form
+MAX_FORM_FIELD_LENGTH = 64
+
+# Stripe's per-charge maximum; also keeps huge exponents like 1e999999 from reaching int()
+MAX_CHECKOUT_AMOUNT = Decimal('999999.99')
+
+# Repeat submissions of the same checkout form within CHECKOUT_CACHE_TTL seconds
+# reuse the Checkout Session already created instead of calling Stripe again
+CHECKOUT_CACHE_TTL = 60
+checkout_cache = TTLCache(maxsize=1024, ttl=CHECKOUT_CACHE_TTL)
+checkout_cache_lock = threading.Lock()
+
+# The fee line only varies in its amount, so its product data is built once
+FEE_PRODUCT_DATA = {'name': 'Convenience Fee', 'description': '5% transaction fee'}
+
+def build_line_items(base_cents, fee_cents, game, username):
+    """Checkout line items: the deposit itself plus the convenience fee"""
+    return [
+        {
+            'price_data': {
+                'currency': 'usd',
+                'product_data': {'name': f"Deposit for {game}", 'description': f"User: {username}"},
+                'unit_amount': base_cents,
+            },
+            'quantity': 1,
+        },
+        {
+            'price_data': {'currency': 'usd', 'product_data': FEE_PRODUCT_DATA, 'unit_amount': fee_cents},
+            'quantity': 1,
+        },
+    ]
 
-# Route for the second index page
-@app.route('/gtmw')
-def alt_index():
-    return render_template('alt_index.html')  # Ensure you have an alt_index.html file in templates
+# Per-client cap on in-flight checkout creations. The rate limit bounds requests per
+# minute; this bounds how many can be waiting on Stripe at the same moment, so it sits
+# well below the 10/minute limit. Slots live in a Redis sorted set scored by start
+# time, so a crashed request's slot expires.
+MAX_CONCURRENT_CHECKOUTS = 3
+CHECKOUT_SLOT_TTL = 60  # seconds
+CHECKOUT_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+checkout_slot_script = redis_client.register_script(CHECKOUT_SLOT_SCRIPT) if redis_client is not None else None
+checkout_slots = collections.Counter()
+checkout_slots_lock = threading.Lock()
+
+def acquire_checkout_slot(client):
+    """Return a slot token for the client, or None if it is at the concurrency cap"""
+    if checkout_slot_script is not None:
+        token = uuid.uuid4().hex
+        acquired = checkout_slot_script(
+            keys=[f"checkout_slots:{client}"],
+            args=[time.time(), CHECKOUT_SLOT_TTL, MAX_CONCURRENT_CHECKOUTS, token]
+        )
+        return token if acquired else None
+
+    with checkout_slots_lock:
+        if checkout_slots[client] >= MAX_CONCURRENT_CHECKOUTS:
+            return None
+        checkout_slots[client] += 1
+        return client
+
+def release_checkout_slot(client, token):
+    """Free a slot taken by acquire_checkout_slot"""
+    if checkout_slot_script is not None:
+        redis_client.zrem(f"checkout_slots:{client}", token)
+        return
+
+    with checkout_slots_lock:
+        checkout_slots[client] -= 1
+        if checkout_slots[client] <= 0:
+            del checkout_slots[client]
+
+# The landing and cancel pages have no per-request content, so render them once at startup and
+# let browsers and any CDN in front keep them for an hour
+with app.app_context():
+    INDEX_HTML = render_template('index.html').encode()
+    ALT_INDEX_HTML = render_template('alt_index.html').encode()  # Ensure you have an alt_index.html file in templates
+    CANCEL_HTML = render_template('cancel.html').encode()
+STATIC_PAGE_HEADERS = {'Cache-Control': 'public, max-age=3600'}
+
+def add_static_page(rule, endpoint, body, access_log=None):
+    """Serve a pre-rendered page at rule, optionally logging each hit"""
+    def view():
+        if access_log:
+            logger.info(access_log)
+        return Response(body, mimetype='text/html', headers=STATIC_PAGE_HEADERS)
+    view.__name__ = view.__qualname__ = endpoint  # Flask-Limiter keys views by name
+    app.add_url_rule(rule, endpoint, view)
+
+add_static_page('/', 'index', INDEX_HTML, access_log="Root route accessed")
+add_static_page('/gtmw', 'alt_index', ALT_INDEX_HTML)
+add_static_page('/cancel', 'cancel', CANCEL_HTML)
 
 @app.route('/create-checkout-session', methods=['POST'])
+@limiter.limit("10/minute")  # Each accepted request can cost a Stripe API call
 def create_checkout_session():
+    logger.info("Checkout session creation attempted")
+    form = request.form
+    username = form.get('username')
+    game = form.get('game')
     try:
-        logger.info("Checkout session creation attempted")
-        base_amount = float(request.form['amount'])
-        username = request.form['username']
-        game = request.form['game']
-        
-        if base_amount < 10:
-            return "Amount must be at least $10.", 400
-        
-        # Calculate 5% convenience fee
-        convenience_fee = base_amount * 0.05
-        total_amount = int(base_amount * 100)  # Stripe expects amounts in cents
-        fee_amount = int(convenience_fee * 100)
+        base_amount = Decimal(form.get('amount', ''))
+    except InvalidOperation:
+        base_amount = None
+    
+    # Reject bad input up front, without going through the exception handler
+    if not username or not game or base_amount is None or not base_amount.is_finite():
+        return jsonify({"error": "An error occurred during checkout. Please try again."}), 400
+    if len(username) > MAX_FORM_FIELD_LENGTH or len(game) > MAX_FORM_FIELD_LENGTH:
+        return jsonify({"error": f"Username and game must be at most {MAX_FORM_FIELD_LENGTH} characters."}), 400
+    if base_amount < 10:
+        return "Amount must be at least $10.", 400
+    if base_amount > MAX_CHECKOUT_AMOUNT:
+        return "Amount must be at most $999,999.99.", 400
+    
+    try:
+        # Work in integer cents (what Stripe expects); Decimal keeps 10.10 at exactly 1010 and
+        # half-cent input rounds up
+        base_cents = int((base_amount * 100).to_integral_value(rounding=ROUND_HALF_UP))
+        fee_cents = base_cents * 5 // 100  # 5% convenience fee
         
-        # Create Stripe Checkout session
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card', 'cashapp'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': f"Deposit for {game}",
-                        'description': f"User: {username}"
-                    },
-                    'unit_amount': total_amount,
-                },
-                'quantity': 1,
-            },
-            {
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': 'Convenience Fee',
-                        'description': '5% transaction fee'
-                    },
-                    'unit_amount': fee_amount,
+        base_url = BASE_URL or request.host_url
+        cache_key = (game, username, base_cents, base_url)
+        with checkout_cache_lock:
+            cached_url = checkout_cache.get(cache_key)
+        if cached_url:
+            logger.info("Reusing checkout session for repeated submission")
+            return redirect(cached_url, code=303)
+
+        # Same key within one cache window, so Stripe dedupes retries that miss the local cache
+        idempotency_window = int(time.time() // CHECKOUT_CACHE_TTL)
+        idempotency_key = hashlib.sha256(
+            f"{username}:{game}:{base_cents}:{base_url}:{idempotency_window}".encode()
+        ).hexdigest()
+        success_url, cancel_url = CHECKOUT_REDIRECT_URLS or checkout_redirect_urls(base_url)
+
+        # Bound how many Stripe calls one client can have in flight at once
+        client = get_remote_address()
+        slot = acquire_checkout_slot(client)
+        if slot is None:
+            logger.warning("Too many concurrent checkout requests from %s", client)
+            return jsonify({"error": "Too many checkout requests in progress. Please try again."}), 429
+        try:
+            # Create Stripe Checkout session
+            checkout_session = stripe.checkout.Session.create(
+                payment_method_types=['card', 'cashapp'],
+                line_items=build_line_items(base_cents, fee_cents, game, username),
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                metadata={
+                    'game': game,
+                    'username': username,
+                    # Stripe stores metadata as strings; send exact two-decimal amounts
+                    'amount': f"{base_cents / 100:.2f}",
+                    'convenience_fee': f"{fee_cents / 100:.2f}"
                 },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=f"{request.host_url}success?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{request.host_url}cancel",
-            metadata={
-                'game': game,
-                'username': username,
-                'amount': base_amount,
-                'convenience_fee': convenience_fee
-            }
-        )
-        return redirect(session.url, code=303)
+                idempotency_key=idempotency_key
+            )
+        finally:
+            release_checkout_slot(client, slot)
+        with checkout_cache_lock:
+            checkout_cache[cache_key] = checkout_session.url
+        return redirect(checkout_session.url, code=303)
     except Exception as e:
-        logger.error(f"Checkout session error: {e}")
+        logger.error("Checkout session error: %s", e)
         return jsonify({"error": "An error occurred during checkout. Please try again."}), 400
 
+# Success page details, filled from the verified checkout.session.completed webhook when
+# it arrives first and from a Stripe lookup otherwise; customers also often refresh the page.
+# Kept in Redis when available so every web worker sees what any one of them stored.
+SUCCESS_CACHE_TTL = 60 * 60
+success_cache = TTLCache(maxsize=10000, ttl=SUCCESS_CACHE_TTL)
+success_cache_lock = threading.Lock()
+
+def success_details(checkout_session):
+    """The details the success page shows for a completed checkout session"""
+    metadata = checkout_session.get('metadata') or {}
+    return {
+        'payment_id': checkout_session['payment_intent'],
+        'amount': checkout_session['amount_total'] / 100,  # Convert from cents
+        'game': metadata.get('game', 'Unknown Game'),
+        'username': metadata.get('username', 'Unknown User')
+    }
+
+def store_success(session_id, payment_info):
+    """Cache success page details for a checkout session"""
+    if redis_client is not None:
+        redis_client.set(f"success:{session_id}", orjson.dumps(payment_info), ex=SUCCESS_CACHE_TTL)
+    else:
+        with success_cache_lock:
+            success_cache[session_id] = payment_info
+
+def remember_success(checkout_session):
+    """Store the details the success page shows for a completed checkout session"""
+    payment_info = success_details(checkout_session)
+    store_success(checkout_session['id'], payment_info)
+    return payment_info
+
+def lookup_success(session_id):
+    """Return the stored success page details for a checkout session, or None"""
+    if redis_client is not None:
+        cached = redis_client.get(f"success:{session_id}")
+        return orjson.loads(cached) if cached else None
+
+    with success_cache_lock:
+        return success_cache.get(session_id)
+
 @app.route('/success')
 def success():
     # Get the session_id from the URL parameter
@@ -129,83 +388,190 @@ def success():
     payment_info = {}
     
     if session_id:
+        # Cache failures are treated as a miss, so the page can still come from Stripe
         try:
-            # Retrieve the checkout session to get payment info
-            checkout_session = stripe.checkout.Session.retrieve(session_id)
-            # Get the payment intent ID
-            payment_intent_id = checkout_session.payment_intent
-            
-            # Store payment details to display
-            payment_info = {
-                'payment_id': payment_intent_id,
-                'amount': checkout_session.amount_total / 100,  # Convert from cents
-                'game': checkout_session.metadata.get('game', 'Unknown Game'),
-                'username': checkout_session.metadata.get('username', 'Unknown User')
-            }
-            logger.info(f"Payment successful, ID: {payment_intent_id}")
+            payment_info = lookup_success(session_id)
         except Exception as e:
-            logger.error(f"Error retrieving session information: {e}")
+            logger.error("Error reading cached session information: %s", e)
+            payment_info = None
+        if not payment_info:
+            try:
+                # Retrieve the checkout session to get payment info
+                payment_info = success_details(stripe.checkout.Session.retrieve(session_id))
+                logger.info("Payment successful, ID: %s", payment_info['payment_id'])
+            except Exception as e:
+                logger.error("Error retrieving session information: %s", e)
+                payment_info = {}
+            else:
+                try:
+                    store_success(session_id, payment_info)
+                except Exception as e:
+                    logger.error("Error caching session information: %s", e)
     
     return render_template('success.html', payment_info=payment_info)
 
-@app.route('/cancel')
-def cancel():
-    return render_template('cancel.html')
+# Stripe delivers webhooks at least once, so retries must not trigger a second email.
+# Processed event IDs are kept in Redis (shared across processes) when available,
+# otherwise in a bounded in-memory map for the single-process setup.
+EVENT_ID_TTL = 7 * 24 * 60 * 60  # Cover Stripe's full retry window
+SEEN_EVENTS_MAX = 10000
+seen_events = collections.OrderedDict()
+seen_events_lock = threading.Lock()
+
+def claim_event(event_id):
+    """Return True the first time an event ID is seen, False on redelivery"""
+    if redis_client is not None:
+        return bool(redis_client.set(f"stripe_evt:{event_id}", "1", nx=True, ex=EVENT_ID_TTL))
+
+    with seen_events_lock:
+        if event_id in seen_events:
+            return False
+        seen_events[event_id] = True
+        if len(seen_events) > SEEN_EVENTS_MAX:
+            seen_events.popitem(last=False)
+    return True
+
+def release_event(event_id):
+    """Forget a claimed event ID so Stripe's retry of it is processed"""
+    if redis_client is not None:
+        redis_client.delete(f"stripe_evt:{event_id}")
+        return
+
+    with seen_events_lock:
+        seen_events.pop(event_id, None)
+
+# Stripe event payloads are a few KB; anything far larger is not a real webhook
+MAX_WEBHOOK_BYTES = 64 * 1024
+WEBHOOK_TOLERANCE = 300  # seconds, same replay window as stripe.Webhook
+# Acknowledgement bodies never change, so they are serialized once rather than per event
+WEBHOOK_OK_BODY = b'{"success":true}'
+WEBHOOK_DUPLICATE_BODY = b'{"success":true,"duplicate":true}'
+# HMAC keyed with the webhook secret once; each verification copies it rather than
+# re-encoding the secret and redoing the key setup
+webhook_hmac = hmac.new(STRIPE_WEBHOOK_SECRET.encode(), digestmod=hashlib.sha256)
+
+def verify_webhook(payload, sig_header):
+    """Check the Stripe-Signature header against the raw payload and return the event dict.
+
+    Same scheme as stripe.Webhook.construct_event, without wrapping the event in
+    StripeObjects the handler only reads two keys from.
+    """
+    timestamp = None
+    signatures = []
+    for item in (sig_header or "").split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+
+    if not timestamp or not (timestamp.isascii() and timestamp.isdigit()) or not signatures:
+        raise stripe.error.SignatureVerificationError(
+            "Unable to extract timestamp and signatures from header", sig_header, payload)
+
+    mac = webhook_hmac.copy()
+    mac.update(timestamp.encode() + b"." + payload)  # One contiguous buffer, hashed in one C call
+    expected = mac.hexdigest().encode()
+    # Compared as bytes: compare_digest rejects str with non-ASCII characters
+    if not any(hmac.compare_digest(expected, signature.encode('utf-8', 'surrogateescape')) for signature in signatures):
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found matching the expected signature for payload", sig_header, payload)
+
+    if int(timestamp) < time.time() - WEBHOOK_TOLERANCE:
+        raise stripe.error.SignatureVerificationError(
+            "Timestamp outside the tolerance zone", sig_header, payload)
+
+    return orjson.loads(payload)
 
 # Webhook route for Stripe
 @app.route('/webhook', methods=['POST'])
+@limiter.limit("1000/minute")  # Stripe delivers in bursts; rejects floods before any HMAC or JSON work
 def stripe_webhook():
-    payload = request.get_data(as_text=True)
-    sig_header = request.headers.get('Stripe-Signature')
-    endpoint_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
+    if request.content_length and request.content_length > MAX_WEBHOOK_BYTES:
+        logger.error("Webhook payload too large: %s bytes", request.content_length)
+        return jsonify(success=False, error="Payload too large"), 413
 
-    logger.info(f"Received webhook: {payload}")
-    logger.info(f"Stripe-Signature: {sig_header}")
+    payload = request.get_data(cache=False)  # Raw bytes, not retained on the request after verification
+    sig_header = request.headers.get('Stripe-Signature')
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
-        logger.info(f"Webhook event type: {event['type']}")
+        event = verify_webhook(payload, sig_header)
+        logger.info("Webhook event %s type=%s", event['id'], event['type'])
+
+        # Other event types are acknowledged without touching the dedup store
+        if event['type'] != 'checkout.session.completed':
+            return Response(WEBHOOK_OK_BODY, mimetype='application/json')
 
-        # IMMEDIATELY RESPOND TO STRIPE
-        response = jsonify(success=True), 200
+        if not claim_event(event['id']):
+            logger.info("Duplicate webhook event ignored: %s", event['id'])
+            return Response(WEBHOOK_DUPLICATE_BODY, mimetype='application/json')
 
-        if event['type'] == 'checkout.session.completed':
-            # Process the webhook in the background
-            import threading
-            thread = threading.Thread(target=process_webhook_event, args=(event,))
-            thread.daemon = True
-            thread.start()
-            logger.info("Webhook processing started in background thread")
+        # Lets the success page render without its own Stripe call; the page can still
+        # fetch from Stripe, so a failure here must not fail the already-claimed event
+        try:
+            remember_success(event['data']['object'])
+        except Exception as e:
+            logger.error("Error caching success page details: %s", e)
+
+        # Hand off to the background worker and respond to Stripe immediately. With a
+        # broker the verified payload goes to the durable Celery queue, so an event
+        # acknowledged here survives a web process restart.
+        if redis_url:
+            try:
+                process_webhook_payload.delay(payload.decode('utf-8'))
+            except Exception:
+                # Let Stripe's retry of this event through, since nothing was queued
+                release_event(event['id'])
+                raise
+        else:
+            webhook_pool.submit(process_webhook_payload, payload)
+        logger.info("Webhook queued for background processing")
 
-        return response
+        return Response(WEBHOOK_OK_BODY, mimetype='application/json')
 
     except ValueError as e:
-        logger.error(f"Invalid payload: {e}")
+        logger.error("Invalid payload: %s", e)
         return jsonify(success=False, error=f"Invalid payload: {e}"), 400
     except stripe.error.SignatureVerificationError as e:
-        logger.error(f"Invalid signature: {e}")
+        logger.error("Invalid signature: %s", e)
         return jsonify(success=False, error=f"Invalid signature: {e}"), 400
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e)
         return jsonify(success=False, error=f"Webhook error: {e}"), 500
 
+# Payment times in the notification email are shown in Central time
+CENTRAL_TZ = ZoneInfo("America/Chicago")
+PAYMENT_TIME_FORMAT = '%I:%M %p %Z'
+PAYMENT_DATE_FORMAT = '%B %d, %Y'
+
+def safe_float(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def parse_metadata(metadata):
+    """Return (game, username, amount, convenience_fee) from checkout session metadata in one pass"""
+    return (
+        metadata.get('game') or 'Unknown Game',
+        metadata.get('username') or 'Unknown User',
+        safe_float(metadata.get('amount')),
+        safe_float(metadata.get('convenience_fee'))
+    )
 
 # New function to process webhook events in the background
 def process_webhook_event(event):
     """Process webhook event asynchronously"""
     try:
-        session = event['data']['object']
+        checkout_session = event.data.object
 
-        amount_received = int(session.amount_total) / 100
+        amount_received = int(checkout_session.amount_total) / 100
 
-        metadata = dict(session.metadata)
+        metadata = dict(checkout_session.metadata)
 
-        game = metadata.get('game', 'Unknown Game')
-        username = metadata.get('username', 'Unknown User')
-        convenience_fee = metadata.get('convenience_fee', 0.0)
-        amount = metadata.get('amount', 0.0)
+        game, username, amount, convenience_fee = parse_metadata(metadata)
 
-        payment_intent_id = session.payment_intent or 'Unknown Payment ID'
+        payment_intent_id = checkout_session.payment_intent or 'Unknown Payment ID'
         
         # Retrieve payment method details
         payment_method_type = "Unknown"
@@ -215,295 +581,294 @@ def process_webhook_event(event):
         
         try:
             if payment_intent_id and payment_intent_id != 'Unknown Payment ID':
-                payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-                
-                if payment_intent.payment_method:
-                    payment_method = stripe.PaymentMethod.retrieve(payment_intent.payment_method)
+                # One round-trip: the PaymentIntent and its PaymentMethod come back inline
+                expanded_session = stripe.checkout.Session.retrieve(
+                    checkout_session.id, expand=['payment_intent.payment_method']
+                )
+                payment_method = expanded_session.payment_intent.payment_method
+
+                if payment_method:
                     payment_method_type = payment_method.type
                     
-                    if payment_method_type == 'card' and hasattr(payment_method, 'card'):
-                        card_last4 = payment_method.card.last4
-                        card_brand = payment_method.card.brand.lower()
+                    # The details sub-object is keyed by the method type; one lookup each
+                    details = payment_method.get(payment_method_type)
+                    if payment_method_type == 'card' and details:
+                        card_last4 = details.get('last4')
+                        card_brand = (details.get('brand') or '').lower() or None
                     
-                    elif payment_method_type == 'cashapp' and hasattr(payment_method, 'cashapp'):
-                        cashapp_cashtag = payment_method.cashapp.cashtag
+                    elif payment_method_type == 'cashapp' and details:
+                        cashapp_cashtag = details.get('cashtag')
                 
-                elif hasattr(payment_intent, 'charges') and payment_intent.charges.data:
-                    latest_charge = payment_intent.charges.data[0]
-                    payment_method_details = latest_charge.payment_method_details
-                    payment_method_type = payment_method_details.type if payment_method_details else 'Unknown'
-                    
-                    if payment_method_type == 'card' and payment_method_details.card:
-                        card_last4 = payment_method_details.card.last4
-                        card_brand = payment_method_details.card.brand.lower()
-                        
-                    elif payment_method_type == 'cashapp' and payment_method_details.cashapp:
-                        cashapp_cashtag = payment_method_details.cashapp.cashtag
-                
-                logger.info(f"Payment method retrieved: {payment_method_type}")
+                logger.info("Payment method retrieved: %s", payment_method_type)
         except Exception as e:
-            logger.error(f"Error retrieving payment method details: {e}")
+            logger.error("Error retrieving payment method details: %s", e)
 
         # Get email from customer_details
         customer_email = (
-            getattr(session, 'customer_email', None)
-            or getattr(session.customer_details, 'email', None)
+            getattr(checkout_session, 'customer_email', None)
+            or getattr(checkout_session.customer_details, 'email', None)
         )
 
         if not customer_email:
             logger.error("No customer email found in Stripe session")
             return
 
-        payment_time_unix = session.created
-        payment_time_utc = datetime.datetime.fromtimestamp(payment_time_unix, pytz.utc)
-        central_tz = pytz.timezone('America/Chicago')
-        payment_time_cst = payment_time_utc.astimezone(central_tz)
-        payment_time = payment_time_cst.strftime('%I:%M %p %Z')
-        payment_date = payment_time_cst.strftime('%B %d, %Y')
-
-        logger.info(f"Webhook metadata: {metadata}")
-
-        # Send email
-        send_email(customer_email, amount_received, game, username, amount, 
-                  convenience_fee, payment_time, payment_date, payment_intent_id,
-                  payment_method_type, card_brand, card_last4, cashapp_cashtag)
+        payment_time_unix = checkout_session.created
+        payment_time_cst = datetime.datetime.fromtimestamp(payment_time_unix, CENTRAL_TZ)
+        payment_time = payment_time_cst.strftime(PAYMENT_TIME_FORMAT)
+        payment_date = payment_time_cst.strftime(PAYMENT_DATE_FORMAT)
+
+        logger.debug("Webhook metadata: %s", metadata)
+
+        # Queue the payment for the next batched notification email
+        queue_payment_email({
+            'customer_email': customer_email,
+            'amount_received': amount_received,
+            'game': game,
+            'username': username,
+            'amount': amount,
+            'convenience_fee': convenience_fee,
+            'payment_time': payment_time,
+            'payment_date': payment_date,
+            'payment_id': payment_intent_id,
+            'payment_method_type': payment_method_type,
+            'card_brand': card_brand,
+            'card_last4': card_last4,
+            'cashapp_cashtag': cashapp_cashtag
+        })
         
-        logger.info(f"Background webhook processing completed for payment: {payment_intent_id}")
+        logger.info("Background webhook processing completed for payment: %s", payment_intent_id)
         
     except Exception as e:
-        logger.error(f"Error in background webhook processing: {e}")
-
-# Function to send email notifications when a payment is successful
-def send_email(customer_email, amount_received, game, username, amount, convenience_fee, 
-              payment_time, payment_date, payment_id, payment_method_type="Unknown", 
-              card_brand=None, card_last4=None, cashapp_cashtag=None):
-    from sendgrid import SendGridAPIClient
-    from sendgrid.helpers.mail import Mail, Email, To, Content
-    
-    from_email = Email("noreply@fkgvload.cfd", "Fire Kirin GV")
-    to_email = To("fkgv.load1@gmail.com")
-    subject = f"New Payment Notification - {payment_id}"
-    
-    # Create payment method display HTML
-    payment_method_html = ""
-    
+        logger.error("Error in background webhook processing: %s", e)
+
+# Entry point for verified webhook payloads, run by a Celery worker or the in-process pool
+@celery.task
+def process_webhook_payload(payload):
+    """Build Stripe objects from the already-verified JSON payload and process the event"""
+    process_webhook_event(stripe.Event.construct_from(orjson.loads(payload), stripe.api_key))
+
+# Verified events are processed on a bounded pool of reused threads, so the webhook
+# handler only pays for signature verification before acknowledging Stripe
+webhook_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_WORKERS", 8)),
+    thread_name_prefix="stripe-wh"
+)
+atexit.register(webhook_pool.shutdown, wait=False)
+
+# Persistent HTTPS session to SendGrid - consecutive emails reuse one keep-alive
+# connection instead of paying a TCP+TLS handshake per send
+SENDGRID_SEND_URL = "https://api.sendgrid.com/v3/mail/send"
+sendgrid_session = requests.Session()
+sendgrid_session.headers.update({
+    "Authorization": f"Bearer {SENDGRID_API_KEY}",
+    "Content-Type": "application/json"
+})
+atexit.register(sendgrid_session.close)
+
+# Sender and recipient never change, so those parts of the mail/send body are built once
+NOTIFY_FROM = {"email": "noreply@fkgvload.cfd", "name": "Fire Kirin GV"}
+NOTIFY_TO = {"email": "fkgv.load1@gmail.com"}
+SENDGRID_PERSONALIZATIONS = [{'to': [NOTIFY_TO]}]
+
+# HTML email body (templates/payment_email.html), loaded and compiled once at import.
+# Flask's environment autoescapes .html templates, which keeps customer-supplied
+# metadata from injecting HTML.
+EMAIL_TEMPLATE = app.jinja_env.get_template('payment_email.html')
+
+# Brand labels for the card networks with their own colours
+CARD_LOGO_HTML = {
+    "visa": '<span style="font-weight: bold; color: #1434CB; margin-right: 5px;">VISA</span>',
+    "mastercard": '<span style="font-weight: bold; color: #EB001B; margin-right: 5px;">MASTERCARD</span>',
+    "amex": '<span style="font-weight: bold; color: #2E77BC; margin-right: 5px;">AMEX</span>',
+    "discover": '<span style="font-weight: bold; color: #FF6000; margin-right: 5px;">DISCOVER</span>',
+}
+
+# Labels for the non-card payment methods
+PAYMENT_METHOD_LOGO_HTML = {
+    "cashapp": '<span style="font-weight: bold; color: #00D632; margin-right: 5px;">CASH APP</span>',
+    "apple_pay": '<span style="font-weight: bold; color: #000000; margin-right: 5px;">APPLE PAY</span>',
+    "google_pay": '<span style="font-weight: bold; color: #4285F4; margin-right: 5px;">GOOGLE PAY</span>',
+}
+
+# Build the payment method display HTML for the notification email. Values from
+# Stripe are escaped here because the result is inserted into the template as Markup.
+def format_payment_method(payment_method_type, card_brand=None, card_last4=None, cashapp_cashtag=None):
     if payment_method_type == "card" and card_brand and card_last4:
-        card_logo_html = ""
-        if card_brand == "visa":
-            card_logo_html = '<span style="font-weight: bold; color: #1434CB; margin-right: 5px;">VISA</span>'
-        elif card_brand == "mastercard":
-            card_logo_html = '<span style="font-weight: bold; color: #EB001B; margin-right: 5px;">MASTERCARD</span>'
-        elif card_brand == "amex":
-            card_logo_html = '<span style="font-weight: bold; color: #2E77BC; margin-right: 5px;">AMEX</span>'
-        elif card_brand == "discover":
-            card_logo_html = '<span style="font-weight: bold; color: #FF6000; margin-right: 5px;">DISCOVER</span>'
-        else:
-            card_logo_html = f'<span style="font-weight: bold; margin-right: 5px;">{card_brand.upper()}</span>'
+        card_logo_html = (
+            CARD_LOGO_HTML.get(card_brand)
+            or f'<span style="font-weight: bold; margin-right: 5px;">{escape(card_brand.upper())}</span>'
+        )
         
-        payment_method_html = f"{card_logo_html} •••• {card_last4}"
+        return f"{card_logo_html} •••• {escape(card_last4)}"
     
-    elif payment_method_type == "cashapp" and cashapp_cashtag:
-        clean_cashtag = cashapp_cashtag
-        if clean_cashtag.startswith('$'):
-            clean_cashtag = clean_cashtag[1:]
-            
-        payment_method_html = f'<span style="font-weight: bold; color: #00D632; margin-right: 5px;">CASH APP</span> ${clean_cashtag}'
+    logo_html = PAYMENT_METHOD_LOGO_HTML.get(payment_method_type)
+    if logo_html is None:
+        return escape(payment_method_type.replace('_', ' ').title())
     
-    elif payment_method_type == "apple_pay":
-        payment_method_html = '<span style="font-weight: bold; color: #000000; margin-right: 5px;">APPLE PAY</span>'
-    
-    elif payment_method_type == "google_pay":
-        payment_method_html = '<span style="font-weight: bold; color: #4285F4; margin-right: 5px;">GOOGLE PAY</span>'
+    if payment_method_type == "cashapp" and cashapp_cashtag:
+        return f"{logo_html} ${escape(cashapp_cashtag.removeprefix('$'))}"
     
+    return logo_html
+
+def build_notification(payments):
+    """SendGrid v3 mail/send body for one notification email covering the given payments"""
+    if len(payments) == 1:
+        subject = f"New Payment Notification - {payments[0]['payment_id']}"
+        summary = "A new payment has been successfully processed."
     else:
-        payment_method_html = payment_method_type.replace('_', ' ').title()
+        subject = f"{len(payments)} New Payment Notifications"
+        summary = f"{len(payments)} new payments have been successfully processed."
     
     # HTML email body
-    html_content = f"""
-    <html>
-    <head>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <style>
-            body {{
-                font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif;
-                color: #333333;
-                line-height: 1.6;
-                margin: 0;
-                padding: 0;
-            }}
-            .email-container {{
-                max-width: 600px;
-                margin: 0 auto;
-                padding: 20px;
-            }}
-            .header {{
-                background-color: #635BFF;
-                color: white;
-                padding: 20px;
-                text-align: center;
-                border-radius: 4px 4px 0 0;
-            }}
-            .content {{
-                background-color: #ffffff;
-                padding: 20px;
-                border: 1px solid #e6e6e6;
-                border-top: none;
-                border-radius: 0 0 4px 4px;
-            }}
-            .info-table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin-bottom: 20px;
-                table-layout: fixed;
-            }}
-            .info-table td {{
-                padding: 10px;
-                border-bottom: 1px solid #e6e6e6;
-                word-wrap: break-word;
-                word-break: break-word;
-            }}
-            .info-table tr:last-child td {{
-                border-bottom: none;
-            }}
-            .label {{
-                color: #888888;
-                width: 40%;
-                vertical-align: top;
-            }}
-            .value {{
-                font-weight: normal;
-            }}
-            .highlight {{
-                font-weight: bold;
-                color: #222222;
-            }}
-            .payment-id {{
-                background-color: #f5f5f5;
-                padding: 8px;
-                border-radius: 4px;
-                font-family: monospace;
-                font-size: 13px;
-                color: #333333;
-                display: inline-block;
-                margin-top: 5px;
-                word-break: break-all;
-                max-width: 100%;
-                box-sizing: border-box;
-            }}
-            .total-amount {{
-                font-size: 18px;
-                color: #635BFF;
-                font-weight: bold;
-            }}
-            .footer {{
-                margin-top: 20px;
-                text-align: center;
-                color: #888888;
-                font-size: 12px;
-            }}
-            .action {{
-                background-color: #f5f5f5;
-                padding: 15px;
-                border-radius: 4px;
-                margin-top: 20px;
-            }}
-            
-            @media screen and (max-width: 480px) {{
-                .info-table, .info-table tbody, .info-table tr, .info-table td {{
-                    display: block;
-                    width: 100%;
-                    box-sizing: border-box;
-                }}
-                .info-table td.label {{
-                    border-bottom: none;
-                    padding-bottom: 0;
-                }}
-                .info-table td.value {{
-                    padding-top: 5px;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="email-container">
-            <div class="header">
-                <h2 style="margin: 0;">Payment Received</h2>
-            </div>
-            <div class="content">
-                <p>A new payment has been successfully processed.</p>
-                
-                <h3>Payment Details</h3>
-                <table class="info-table">
-                    <tr>
-                        <td class="label">Payment ID</td>
-                        <td class="value highlight">
-                            <div class="payment-id">{payment_id}</div>
-                        </td>
-                    </tr>
-                    <tr>
-                        <td class="label">Date</td>
-                        <td class="value">{payment_date}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Time</td>
-                        <td class="value">{payment_time}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Customer</td>
-                        <td class="value">{customer_email}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Game</td>
-                        <td class="value">{game}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Username</td>
-                        <td class="value">{username}</td>
-                    </tr>
-                    <tr>
-                        <td class="label"><strong>Deposit Amount</strong></td>
-                        <td class="value" style="font-weight: bold; font-size: 1.2em;">${amount}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Convenience Fee</td>
-                        <td class="value">${convenience_fee}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Total Amount</td>
-                        <td class="value total-amount">${amount_received}</td>
-                    </tr>
-                    <tr>
-                        <td class="label">Payment Method</td>
-                        <td class="value">{payment_method_html}</td>
-                    </tr>
-                </table>
-                
-                <div class="action">
-                    <p><strong>Action Required:</strong> Please load the payment and send customer confirmation as soon as possible.</p>
-                </div>
-            </div>
-            <div class="footer">
-                <p>This is an automated notification from Fire Kirin GV. Do not reply to this email.</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
+    html_content = EMAIL_TEMPLATE.render(
+        summary=summary,
+        payments=[
+            dict(payment, payment_method_html=Markup(format_payment_method(
+                payment['payment_method_type'], payment['card_brand'],
+                payment['card_last4'], payment['cashapp_cashtag']
+            )))
+            for payment in payments
+        ]
+    )
+    
+    # Built directly rather than through the SendGrid Mail helper objects
+    return {
+        'personalizations': SENDGRID_PERSONALIZATIONS,
+        'from': NOTIFY_FROM,
+        'subject': subject,
+        'content': [{'type': 'text/html', 'value': html_content}]
+    }
+
+def deliver_notification(message):
+    """Post a mail/send body to SendGrid and return the response"""
+    response = sendgrid_session.post(SENDGRID_SEND_URL, data=orjson.dumps(message), timeout=30)
+    response.raise_for_status()
+    return response
+
+EMAIL_RETRY_BACKOFF = 30  # seconds
+EMAIL_RETRY_BACKOFF_MAX = 600
+
+def is_retryable_send_error(error):
+    """True only when SendGrid certainly did not accept the email: the connection could
+    not be opened, or SendGrid answered 429. Read timeouts, dropped responses and 5xx
+    may follow an accepted send, so retrying them could duplicate the email."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 429
+
+def send_notification(task, payments):
+    """Send one notification email for the payments, retrying the task on transient failures"""
+    message = build_notification(payments)
     
     try:
-        message = Mail(
-            from_email=from_email,
-            to_emails=to_email,
-            subject=subject,
-            html_content=html_content
-        )
-        
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        response = sg.send(message)
-        logger.info(f"Email sent successfully to {to_email.email}. Status code: {response.status_code}")
-        
-    except Exception as e:
-        logger.error(f"Error sending email via SendGrid: {e}")
+        response = deliver_notification(message)
+    except requests.RequestException as e:
+        logger.error("Error sending email via SendGrid: %s", e)
+        if task.request.is_eager or not is_retryable_send_error(e):
+            raise
+        raise task.retry(exc=e, countdown=get_exponential_backoff_interval(
+            EMAIL_RETRY_BACKOFF, task.request.retries, EMAIL_RETRY_BACKOFF_MAX, full_jitter=True
+        ))
+    logger.info("Email for %s payment(s) sent successfully to %s. Status code: %s", len(payments), NOTIFY_TO['email'], response.status_code)
+
+# Celery task to send one notification email covering a batch of successful payments.
+# Sends SendGrid never received (see is_retryable_send_error) are retried up to 5 times,
+# each after a random delay of up to 30s, 60s, 120s, ... (capped at 10 minutes). Other
+# errors, such as a rejected API key or payload, fail at once. Without a broker the task runs inline, where a
+# retry would fire immediately, so it is not retried.
+@celery.task(bind=True, max_retries=5)
+def send_email(self, payments):
+    send_notification(self, payments)
+
+# Payments completed within a short window are coalesced into one notification
+# email, so a burst of checkouts costs one SendGrid call instead of one per payment.
+# With a broker the pending payments are kept in a Redis list and flushed by
+# send_email_batch; otherwise an in-process batcher thread collects them.
+EMAIL_BATCH_WINDOW = float(os.getenv("EMAIL_BATCH_WINDOW", 2))  # seconds
+EMAIL_BATCH_MAX = int(os.getenv("EMAIL_BATCH_MAX", 50))
+EMAIL_BATCH_KEY = "email_batch"
+EMAIL_SENDING_TTL = 7 * 24 * 60 * 60  # How long a claimed batch outlives a send that never succeeds
+# Move up to ARGV[1] payments from the pending list onto a send's own list in one atomic step
+EMAIL_BATCH_CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return items
+"""
+email_batch_claim = redis_client.register_script(EMAIL_BATCH_CLAIM_SCRIPT) if redis_client is not None else None
+
+# Claimed payments stay on a list named after the task until SendGrid accepts the email.
+# The task is acknowledged only once it finishes, so a retry, or a redelivery after the
+# worker dies, sends the same payments again instead of losing them.
+@celery.task(bind=True, max_retries=5, acks_late=True, reject_on_worker_lost=True)
+def send_email_batch(self):
+    """Send the payments pending in Redis as one notification email"""
+    sending_key = f"{EMAIL_BATCH_KEY}:sending:{self.request.id}"
+    items = redis_client.lrange(sending_key, 0, -1)
+    if not items:
+        items = email_batch_claim(keys=[EMAIL_BATCH_KEY, sending_key], args=[EMAIL_BATCH_MAX, EMAIL_SENDING_TTL])
+    if not items:
+        return  # An earlier flush already took these payments
+    send_notification(self, [orjson.loads(item) for item in items])
+    redis_client.delete(sending_key)
+
+email_batch_queue = queue.Queue()
+
+def next_email_batch():
+    """Wait for queued payments and return up to EMAIL_BATCH_MAX of them"""
+    payments = [email_batch_queue.get()]
+    deadline = time.monotonic() + EMAIL_BATCH_WINDOW
+    while len(payments) < EMAIL_BATCH_MAX:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            payments.append(email_batch_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return payments
+
+def email_batcher():
+    """Collect queued payments for up to EMAIL_BATCH_WINDOW seconds, then send them together"""
+    while True:
+        payments = next_email_batch()
+        try:
+            send_email.delay(payments)
+        except Exception as e:
+            logger.error("Error queueing notification email, will retry: %s", e)
+            for payment in payments:
+                email_batch_queue.put(payment)
+            time.sleep(EMAIL_BATCH_WINDOW)
+
+# The batcher thread is started on first use rather than at import
+email_batcher_thread = None
+email_batcher_lock = threading.Lock()
+
+def start_email_batcher():
+    """Start the batcher thread in this process if it isn't running"""
+    global email_batcher_thread
+    with email_batcher_lock:
+        if email_batcher_thread is None or not email_batcher_thread.is_alive():
+            email_batcher_thread = threading.Thread(target=email_batcher, name="email-batcher", daemon=True)
+            email_batcher_thread.start()
+
+def queue_payment_email(payment):
+    """Add a payment to the next batched notification email"""
+    if redis_client is not None:
+        redis_client.rpush(EMAIL_BATCH_KEY, orjson.dumps(payment))
+        # Every payment schedules a flush; flushes that find the list already drained do nothing
+        send_email_batch.apply_async(countdown=EMAIL_BATCH_WINDOW)
+        return
+    start_email_batcher()
+    email_batch_queue.put(payment)
 
 @app.route('/GameLinks_files/<path:filename>')
 def gamelinks_files(filename):
@@ -513,13 +878,22 @@ def gamelinks_files(filename):
 def game_links():
     return render_template('GameLinks.html')
 
-# Run the app using Waitress
+# Run the app using Waitress for local runs (the Procfile serves it with gunicorn + gevent)
 if __name__ == "__main__":
     port = os.environ.get('PORT', 5000)
-    logger.info(f"Attempting to start server on port {port}")
+    logger.info("Attempting to start server on port %s", port)
     
     try:
-        serve(app, host="0.0.0.0", port=int(port))
+        # More threads than Waitress's default 4, so a few slow Stripe calls can't stall every request
+        serve(
+            app,
+            host="0.0.0.0",
+            port=int(port),
+            threads=int(os.getenv("WAITRESS_THREADS", 16)),
+            connection_limit=1000,
+            channel_timeout=120,
+            cleanup_interval=30
+        )
     except Exception as e:
-        logger.error(f"Server startup error: {e}")
+        logger.error("Server startup error: %s", e)
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,22 @@
+# Gunicorn settings for the web process (loaded automatically by `gunicorn app:app`)
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# gevent workers patch sockets on startup, so each worker multiplexes its Stripe,
+# SendGrid and Redis calls instead of blocking one thread per request
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+
+# Size the worker count to the Railway plan's CPUs without a Procfile change. Without
+# REDIS_URL, webhook dedup, rate limits and checkout slots live in process memory, so
+# a second worker would let a redelivered event send a duplicate email; the count is
+# then fixed at 1 whatever WEB_CONCURRENCY says.
+if os.getenv("REDIS_URL"):
+    workers = int(os.getenv("WEB_CONCURRENCY", 2))
+else:
+    workers = 1
+
+def on_starting(server):
+    if not os.getenv("REDIS_URL") and int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        server.log.warning("WEB_CONCURRENCY ignored: more than one worker requires REDIS_URL")